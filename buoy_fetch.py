@@ -0,0 +1,43 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+
+# Base URL for NOAA BuoyCAM images
+base_url = "https://www.ndbc.noaa.gov/buoycam.php?station={}"
+
+# Number of concurrent downloads
+max_workers = 8
+
+# Shared HTTP session so connections are kept alive across fetches;
+# the pool is sized to match the number of download workers
+session = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=max_workers,
+    pool_maxsize=max_workers,
+    max_retries=Retry(total=2, backoff_factor=0.3),
+)
+session.mount("https://", adapter)
+
+def fetch_bytes(buoy_id):
+    """Fetch the latest image for a given buoy ID as raw JPEG bytes."""
+    try:
+        url = base_url.format(buoy_id)
+        response = session.get(url, timeout=(3, 10))
+        response.raise_for_status()
+
+        if "image" not in response.headers.get("Content-Type", ""):  # Validate image content
+            print(f"Invalid image for buoy {buoy_id}")
+            return None
+
+        print(f"Image fetched for buoy {buoy_id}")
+        return response.content
+    except requests.RequestException as e:
+        print(f"Failed to fetch image for buoy {buoy_id}: {e}")
+        return None
+
+def fetch_many(buoy_ids, workers=max_workers):
+    """Fetch images for several buoys concurrently, in the order given."""
+    # Downloads are I/O-bound, so a thread pool keeps several requests in flight
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fetch_bytes, buoy_ids))
@@ -1,9 +1,13 @@
 import os
-import requests
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from PIL import Image
 from io import BytesIO
+import numpy as np
+import cv2
+from buoy_fetch import fetch_many, max_workers
 
 # Buoy IDs
 buoy_ids = [
@@ -17,60 +21,60 @@ buoy_ids = [
 output_dir = "./buoy_images"
 os.makedirs(output_dir, exist_ok=True)
 
-# Base URL for NOAA BuoyCAM images
-base_url = "https://www.ndbc.noaa.gov/buoycam.php?station={}"
-
-def fetch_buoy_image(buoy_id):
-    """Fetch the latest image for a given buoy ID."""
+def save_image(image_path, content):
+    """Write downloaded image bytes to disk."""
     try:
-        url = base_url.format(buoy_id)
-        response = requests.get(url)
-        response.raise_for_status()
-
-        # Save the image locally
-        image_path = os.path.join(output_dir, f"{buoy_id}.jpg")
         with open(image_path, "wb") as f:
-            f.write(response.content)
-        print(f"Image saved for buoy {buoy_id}: {image_path}")
-        return image_path
-    except requests.RequestException as e:
-        print(f"Failed to fetch image for buoy {buoy_id}: {e}")
-        return None
+            f.write(content)
+        print(f"Image saved: {image_path}")
+    except OSError as e:
+        print(f"Failed to save image {image_path}: {e}")
 
 def create_gallery():
     """Fetch images for all buoys and create a gallery."""
     images = []
-    for buoy_id in buoy_ids:
-        image_path = fetch_buoy_image(buoy_id)
-        if image_path:
-            try:
-                images.append(Image.open(image_path))
-            except Exception as e:
-                print(f"Error loading image for buoy {buoy_id}: {e}")
+    # Downloads are fetched concurrently; processing stays serial
+    results = fetch_many(buoy_ids)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for buoy_id, content in zip(buoy_ids, results):
+            if content:
+                image_path = os.path.join(output_dir, f"{buoy_id}.jpg")
+                # Write the image to disk in the background and decode from memory
+                executor.submit(save_image, image_path, content)
+                try:
+                    images.append(np.asarray(Image.open(BytesIO(content)).convert("RGB")))
+                except Exception as e:
+                    print(f"Error loading image for buoy {buoy_id}: {e}")
 
     # Combine images into a single gallery
     if images:
-        gallery_width = max(img.width for img in images)
-        gallery_height = sum(img.height for img in images)
-        gallery = Image.new("RGB", (gallery_width, gallery_height))
-
-        y_offset = 0
-        for img in images:
-            gallery.paste(img, (0, y_offset))
-            y_offset += img.height
+        # Pad narrower images on the right so they can be stacked in one pass
+        gallery_width = max(img.shape[1] for img in images)
+        images = [
+            cv2.copyMakeBorder(img, 0, 0, 0, gallery_width - img.shape[1], cv2.BORDER_CONSTANT, value=0)
+            if img.shape[1] < gallery_width else img
+            for img in images
+        ]
+        gallery = cv2.cvtColor(np.vstack(images), cv2.COLOR_RGB2BGR)
 
         # Save the gallery
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         gallery_path = os.path.join(output_dir, f"gallery_{timestamp}.jpg")
-        gallery.save(gallery_path)
-        print(f"Gallery created: {gallery_path}")
+        if cv2.imwrite(gallery_path, gallery, [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 1]):
+            print(f"Gallery created: {gallery_path}")
+        else:
+            print(f"Failed to write gallery: {gallery_path}")
     else:
         print("No images available for gallery.")
 
 if __name__ == "__main__":
     schedule_interval = 3600/4  # Fetch images every 15 minutes
+    schedule_jitter = 60  # Randomize each wait by up to a minute
     while True:
         print("Updating gallery...")
         create_gallery()
-        print(f"Waiting for {schedule_interval} seconds...")
-        time.sleep(schedule_interval)
+        # Jitter the wait so polling doesn't stay phase-locked with NOAA's updates
+        wait = schedule_interval + random.uniform(-schedule_jitter, schedule_jitter)
+        print(f"Waiting for {wait:.0f} seconds...")
+        time.sleep(wait)
@@ -1,11 +1,14 @@
 import os
-import requests
+import atexit
+import hashlib
+import json
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from PIL import Image, ImageChops
-from io import BytesIO
 import numpy as np
 import cv2
+from buoy_fetch import fetch_many, max_workers
 
 # Buoy IDs
 buoy_ids = [
@@ -19,130 +22,231 @@ buoy_ids = [
 output_dir = "./buoy_images"
 os.makedirs(output_dir, exist_ok=True)
 
-# Base URL for NOAA BuoyCAM images
-base_url = "https://www.ndbc.noaa.gov/buoycam.php?station={}"
-
-def fetch_buoy_image(buoy_id):
-    """Fetch the latest image for a given buoy ID."""
+# Scale factor applied to panels before horizon detection
+hough_scale = 0.25
+
+# Cache of buoy ID -> (image digest, processed image (height, width), or None if blank),
+# used to skip reprocessing images that haven't changed since the last cycle.
+# Each gallery script processes images differently, so caches are per script.
+script_name = os.path.splitext(os.path.basename(__file__))[0]
+cache_path = os.path.join(output_dir, f"{script_name}_cache.json")
+_cache = {}
+
+# Processed images are kept in a memory-mapped store with one fixed-size slot
+# per buoy, so unchanged images are reused without decoding. Slots fit both
+# BuoyCAM formats (2000x330 and 2880x300). Like the index, the store is per
+# script, since each script stores panels in its own color order and alignment.
+panel_store_path = os.path.join(output_dir, f"{script_name}_panels.cache")
+panel_store_shape = (len(buoy_ids), 330, 2880, 3)
+panel_store = None
+
+def load_cache():
+    """Open the processed image store and load its cache index, if present."""
+    global panel_store
+    store_size = int(np.prod(panel_store_shape))
+    reuse = os.path.exists(panel_store_path) and os.path.getsize(panel_store_path) == store_size
+    panel_store = np.memmap(panel_store_path, dtype=np.uint8, mode="r+" if reuse else "w+", shape=panel_store_shape)
+    if not reuse:  # The cache index is meaningless without its store
+        return
+    try:
+        with open(cache_path) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return
+    for buoy_id, (digest, size) in entries.items():
+        _cache[int(buoy_id)] = (bytes.fromhex(digest), tuple(size) if size else None)
+
+def save_cache():
+    """Flush the processed image store and save its cache index to disk."""
+    if panel_store is not None:
+        panel_store.flush()
+    entries = {
+        str(buoy_id): [digest.hex(), size]
+        for buoy_id, (digest, size) in _cache.items()
+    }
+    # Write then rename so an interrupted save never leaves a partial index
+    temp_path = cache_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(entries, f)
+    os.replace(temp_path, cache_path)
+
+def save_image(image_path, content):
+    """Write downloaded image bytes to disk."""
     try:
-        url = base_url.format(buoy_id)
-        response = requests.get(url)
-        response.raise_for_status()
-
-        if "image" not in response.headers.get("Content-Type", ""):  # Validate image content
-            print(f"Invalid image for buoy {buoy_id}")
-            return None
-
-        # Save the image locally
-        image_path = os.path.join(output_dir, f"{buoy_id}.jpg")
         with open(image_path, "wb") as f:
-            f.write(response.content)
-        print(f"Image saved for buoy {buoy_id}: {image_path}")
-        return image_path
-    except requests.RequestException as e:
-        print(f"Failed to fetch image for buoy {buoy_id}: {e}")
-        return None
-
-def is_blank_image(image):
-    """Check if an image is mostly blank (e.g., white, black, or uniform colors)."""
-    grayscale = image.convert("L")
-    hist = grayscale.histogram()
-    total_pixels = sum(hist)
-    if hist[-1] > 0.95 * total_pixels or hist[0] > 0.95 * total_pixels:  # Mostly white or black
-        return True
-    if max(hist) > 0.95 * total_pixels:  # Uniform colors
-        return True
-    return False
-
-def align_horizon(image):
-    """Align the horizon line in an image using Hough Line Transform."""
-    # Convert image to grayscale
-    grayscale = np.array(image.convert("L"))
+            f.write(content)
+        print(f"Image saved: {image_path}")
+    except OSError as e:
+        print(f"Failed to save image {image_path}: {e}")
+
+def find_blank_images(images):
+    """Check which BGR image arrays are mostly blank (e.g., white, black, or uniform colors).
+
+    Returns a boolean array with one entry per image. Images of the same size
+    are stacked so the white/black checks run as one batched pass.
+    """
+    grayscale = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) for image in images]
+    blank = np.zeros(len(grayscale), dtype=bool)
+
+    same_size = {}
+    for i, gray in enumerate(grayscale):
+        same_size.setdefault(gray.shape, []).append(i)
+    for indices in same_size.values():
+        stack = np.stack([grayscale[i] for i in indices])
+        white = (stack >= 250).mean(axis=(1, 2))
+        black = (stack <= 5).mean(axis=(1, 2))
+        blank[indices] = (white > 0.95) | (black > 0.95)  # Mostly white or black
+
+    for i in np.flatnonzero(~blank):
+        counts = np.bincount(grayscale[i].ravel(), minlength=256)
+        blank[i] = counts.max() > 0.95 * grayscale[i].size  # Uniform colors
+    return blank
+
+def align_horizon(panel):
+    """Align the horizon line in a BGR panel array using Hough Line Transform."""
+    # Convert panel to grayscale
+    grayscale = cv2.cvtColor(panel, cv2.COLOR_BGR2GRAY)
+
+    # Nearly uniform panels (open sky or sea) have no horizon to detect
+    if grayscale.std() < 5.0:
+        return panel
+
+    # The horizon angle doesn't depend on resolution, so estimate it on a
+    # downsampled copy and apply it to the full-resolution panel. Panels too
+    # small to downsample without collapsing to zero rows are used as-is.
+    scale = hough_scale
+    if round(min(grayscale.shape) * scale) < 1:
+        scale = 1.0
+    small = grayscale
+    if scale < 1.0:
+        small = cv2.resize(grayscale, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
 
     # Apply Canny edge detection
-    edges = cv2.Canny(grayscale, 50, 150)
-
-    # Apply Hough Line Transform
-    lines = cv2.HoughLines(edges, 1, np.pi / 180, 150)
+    edges = cv2.Canny(small, 50, 150)
+
+    # Apply Probabilistic Hough Line Transform; line votes scale with length,
+    # so the threshold is scaled linearly with the image
+    lines = cv2.HoughLinesP(
+        edges, 1, np.pi / 180, max(30, int(150 * scale)),
+        minLineLength=edges.shape[1] // 3, maxLineGap=10,
+    )
+    horizon_angle = 0
     if lines is not None:
-        angles = [np.rad2deg(theta) - 90 for rho, theta in lines[:, 0]]
-        mean_angle = np.mean(angles)
-    else:
-        mean_angle = 0
-
-    # Rotate the image to correct the horizon
-    rotated_image = image.rotate(-mean_angle, resample=Image.BICUBIC, expand=True)
-    return rotated_image
+        x1, y1, x2, y2 = lines.reshape(-1, 4).T  # (N, 1, 4) on OpenCV 4, (N, 4) on 5
+        angles = np.degrees(np.arctan2(y2 - y1, x2 - x1))
+        angles = (angles + 90) % 180 - 90  # Fold segment direction into [-90, 90)
+        # Use the median of near-horizontal segments to ignore vertical outliers
+        angles = angles[np.abs(angles) < 30]
+        if angles.size:
+            horizon_angle = np.median(angles)
+
+    # Rotate the panel about its center to correct the horizon
+    height, width = panel.shape[:2]
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), -float(horizon_angle), 1.0)
+    rotated_panel = cv2.warpAffine(panel, rotation, (width, height), flags=cv2.INTER_CUBIC)
+    return rotated_panel
 
 def process_and_split_image(image):
-    """Split the image into 6 panels, align each panel's horizon, and recombine."""
-    width, height = image.size
+    """Split a BGR image array into 6 panels, align each panel's horizon, and recombine."""
+    height = image.shape[0]
     if height < 6:  # Handle small images
         print("Image height is too small to split into 6 panels.")
         return image
 
-    panel_height = height // 6
-    aligned_panels = []
+    # The panels are views into the image array, not copies
+    panels = np.array_split(image, 6, axis=0)
+    aligned_panels = [align_horizon(panel) for panel in panels]
 
-    for i in range(6):
-        panel = image.crop((0, i * panel_height, width, (i + 1) * panel_height))
-        aligned_panel = align_horizon(panel)
-        aligned_panels.append(aligned_panel)
-
-    # Combine aligned panels back into a single image
-    combined_height = sum(panel.height for panel in aligned_panels)
-    combined_image = Image.new("RGB", (width, combined_height))
-    y_offset = 0
-    for panel in aligned_panels:
-        combined_image.paste(panel, (0, y_offset))
-        y_offset += panel.height
-
-    # Trim excess from top and bottom
-    trim_top = max(0, aligned_panels[0].height - panel_height)
-    trim_bottom = max(0, aligned_panels[-1].height - panel_height)
-    trimmed_image = combined_image.crop((0, trim_top, width, combined_height - trim_bottom))
-
-    return trimmed_image
+    # Combine aligned panels back into a single image. Panels keep their
+    # original size when rotated, so there is no excess to trim.
+    return np.vstack(aligned_panels)
 
 def create_gallery():
     """Fetch images for all buoys and create a gallery."""
-    images = []
-    for buoy_id in buoy_ids:
-        image_path = fetch_buoy_image(buoy_id)
-        if image_path:
+    if panel_store is None:
+        load_cache()
+    processed = {}
+    decoded = []
+    # Downloads are fetched concurrently; processing stays serial
+    results = fetch_many(buoy_ids)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for buoy_id, content in zip(buoy_ids, results):
+            if content:
+                image_path = os.path.join(output_dir, f"{buoy_id}.jpg")
+                digest = hashlib.blake2b(content, digest_size=16).digest()
+                # Reuse the previous cycle's result if the image hasn't changed
+                cached = _cache.get(buoy_id)
+                if cached and cached[0] == digest:
+                    if cached[1] is None:
+                        print(f"Skipping unchanged blank image for buoy {buoy_id}")
+                    else:
+                        height, width = cached[1]
+                        processed[buoy_id] = panel_store[buoy_ids.index(buoy_id), :height, :width]
+                    continue
+
+                # Write the image to disk in the background and decode from memory
+                executor.submit(save_image, image_path, content)
+                img = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+                if img is None:
+                    print(f"Error decoding image for buoy {buoy_id}")
+                    continue
+                decoded.append((buoy_id, digest, img))
+
+        # Check all new images for blanks in one batch before processing
+        blank = find_blank_images([img for _, _, img in decoded])
+        for (buoy_id, digest, img), is_blank in zip(decoded, blank):
+            if is_blank:
+                print(f"Skipping blank image for buoy {buoy_id}")
+                _cache[buoy_id] = (digest, None)
+                continue
             try:
-                with Image.open(image_path) as img:
-                    if is_blank_image(img):
-                        print(f"Skipping blank image for buoy {buoy_id}")
-                        continue
-                    processed_img = process_and_split_image(img)
-                    images.append(processed_img)
+                processed_img = process_and_split_image(img)
+                height, width = processed_img.shape[:2]
+                if height <= panel_store_shape[1] and width <= panel_store_shape[2]:
+                    panel_store[buoy_ids.index(buoy_id), :height, :width] = processed_img
+                    _cache[buoy_id] = (digest, (height, width))
+                else:  # Too large for a store slot, so reprocess it next cycle
+                    _cache.pop(buoy_id, None)
+                processed[buoy_id] = processed_img
             except Exception as e:
                 print(f"Error processing image for buoy {buoy_id}: {e}")
 
+    images = [processed[buoy_id] for buoy_id in buoy_ids if buoy_id in processed]
+
+    # Save the cache every cycle so a restart after a crash or SIGTERM stays warm
+    save_cache()
+
     # Combine images into a single gallery
     if images:
-        gallery_width = max(img.width for img in images)
-        gallery_height = sum(img.height for img in images)
-        gallery = Image.new("RGB", (gallery_width, gallery_height))
-
-        y_offset = 0
-        for img in images:
-            gallery.paste(img, (0, y_offset))
-            y_offset += img.height
+        # Pad narrower images on the right so they can be stacked in one pass
+        gallery_width = max(img.shape[1] for img in images)
+        images = [
+            cv2.copyMakeBorder(img, 0, 0, 0, gallery_width - img.shape[1], cv2.BORDER_CONSTANT, value=0)
+            if img.shape[1] < gallery_width else img
+            for img in images
+        ]
+        gallery = np.vstack(images)
 
         # Save the gallery
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         gallery_path = os.path.join(output_dir, f"gallery_{timestamp}.jpg")
-        gallery.save(gallery_path)
-        print(f"Gallery created: {gallery_path}")
+        if cv2.imwrite(gallery_path, gallery, [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 1]):
+            print(f"Gallery created: {gallery_path}")
+        else:
+            print(f"Failed to write gallery: {gallery_path}")
     else:
         print("No images available for gallery.")
 
 if __name__ == "__main__":
+    load_cache()
+    atexit.register(save_cache)
     schedule_interval = 3600  # Fetch images every hour
+    schedule_jitter = 60  # Randomize each wait by up to a minute
     while True:
         print("Updating gallery...")
         create_gallery()
-        print(f"Waiting for {schedule_interval} seconds...")
-        time.sleep(schedule_interval)
+        # Jitter the wait so polling doesn't stay phase-locked with NOAA's updates
+        wait = schedule_interval + random.uniform(-schedule_jitter, schedule_jitter)
+        print(f"Waiting for {wait:.0f} seconds...")
+        time.sleep(wait)
@@ -15,7 +15,17 @@ source $env_name/bin/activate
 pip install --upgrade pip
 
 # Install required Python packages
-pip install requests Pillow numpy opencv-python
+pip install requests numpy opencv-python
+
+# Install Pillow-SIMD, a drop-in Pillow fork with SSE4/AVX2 image operations.
+# An AVX2 build crashes on CPUs without AVX2, so only use it when the CPU
+# supports it; it builds from source, so also fall back if the build fails.
+pip uninstall -y Pillow
+if grep -qw avx2 /proc/cpuinfo 2>/dev/null; then
+    CC="cc -mavx2" pip install pillow-simd || pip install Pillow
+else
+    pip install Pillow
+fi
 
 # Optional: Install additional packages for OpenCV features
 pip install opencv-contrib-python